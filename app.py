@@ -2,51 +2,92 @@
 import os
 import logging
 import secrets
+import hmac
+import base64
+import binascii
+import uuid
+import hashlib
 import re
 import csv
 import io
+import threading
+import orjson
 import requests
 
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from cachetools import TTLCache
 from flask import Flask, request, abort, jsonify, Response
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from supabase import create_client
-from datetime import datetime, timezone
+from supabase.lib.client_options import ClientOptions
 
 # ==================================================
 # Auth
 # ==================================================
 
+# read once at import; compared as bytes so non-ASCII headers can't raise
+M_API_KEY = os.environ.get("M_API_KEY", "").encode()
+C_API_KEY = os.environ.get("C_API_KEY", "").encode()
+
+def key_matches(header: str, key: bytes) -> bool:
+    given = request.headers.get(header, "").encode()
+    return bool(key) and hmac.compare_digest(given, key)
+
+def is_m() -> bool:
+    return key_matches("X-M-Key", M_API_KEY)
+
+def is_c() -> bool:
+    return key_matches("X-C-Key", C_API_KEY)
+
 def require_m():
-    if request.headers.get("X-M-Key") != os.environ.get("M_API_KEY"):
+    if not is_m():
         abort(403)
 
 def require_c():
-    if request.headers.get("X-C-Key") != os.environ.get("C_API_KEY"):
+    if not is_c():
         abort(403)
 
 def require_viewer():
-    if (
-        request.headers.get("X-M-Key") != os.environ.get("M_API_KEY")
-        and request.headers.get("X-C-Key") != os.environ.get("C_API_KEY")
-    ):
+    if not is_m() and not is_c():
         abort(403)
 
 # ==================================================
 # App + DB
 # ==================================================
 
+class ORJSONProvider(DefaultJSONProvider):
+    # orjson for jsonify and request.get_json; Flask's default hook still
+    # handles types orjson doesn't know
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app, allow_headers=["Content-Type", "X-M-Key", "X-C-Key"])
 
 logging.basicConfig(level=logging.INFO)
 
-supabase = create_client(
-    os.environ["SUPABASE_URL"],
-    os.environ["SUPABASE_SERVICE_KEY"],
-)
+# one client per process: its PostgREST httpx.Client keeps connections
+# alive across requests and threads
+@lru_cache(maxsize=1)
+def get_supabase():
+    return create_client(
+        os.environ["SUPABASE_URL"],
+        os.environ["SUPABASE_SERVICE_KEY"],
+        options=ClientOptions(postgrest_client_timeout=10),
+    )
 
 MAILGUN_DOMAIN = os.environ["MAILGUN_DOMAIN"]
 MAILGUN_API_KEY = os.environ["MAILGUN_API_KEY"]
+MAILGUN_URL = f"https://api.mailgun.net/v3/{MAILGUN_DOMAIN}/messages"
+MAILGUN_AUTH = ("api", MAILGUN_API_KEY)
 FROM_EMAIL = os.environ.get(
     "FROM_EMAIL", "Campaign <campaign@mg.renewableenergyx.com>"
 )
@@ -54,7 +95,65 @@ REPLY_TO = os.environ.get(
     "REPLY_TO", "reply@mg.renewableenergyx.com"
 )
 
+# max concurrent Mailgun requests per send; lower it to stay under the
+# account's rate limit
+SEND_WORKERS = int(os.environ.get("SEND_WORKERS", 32))
+
+# campaigns whose content can no longer change
+EDIT_LOCKED_STATUSES = ["sending", "sent"]
+
+# campaigns /send accepts; a partial send retries its unsent recipients
+SENDABLE_STATUSES = ["ready", "partial"]
+
+# a 'sending' claim not refreshed for this long is taken to be abandoned
+# (restart, crashed job), and /send may claim the campaign again
+SEND_CLAIM_TIMEOUT = timedelta(minutes=30)
+
+# /replies page size, default and cap
+REPLIES_PAGE_SIZE = 50
+REPLIES_MAX_PAGE_SIZE = 1000
+
+# Mailgun's limit on recipients per batch send
+MAILGUN_BATCH_SIZE = 1000
+
+# campaign sends run here after /send returns; one job at a time so
+# campaigns don't compete for the Mailgun rate limit
+SEND_QUEUE = ThreadPoolExecutor(max_workers=1, thread_name_prefix="send")
+
+# keep-alive connections to Mailgun, shared by the send workers
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
+
 EMAIL_RE = re.compile(r"([A-Z0-9._%+\-]+@[A-Z0-9.\-]+\.[A-Z]{2,})", re.I)
+QUOTE_RE = re.compile(r"\n(?:On |From:|>)")
+# replies.id in a /replies cursor: bigint (short enough not to overflow)
+# or uuid
+REPLY_ID_RE = re.compile(
+    r"[0-9]{1,18}|[0-9a-f]{8}-(?:[0-9a-f]{4}-){3}[0-9a-f]{12}", re.I
+)
+
+# per-recipient Reply-To is reply+<campaign>.<token>@domain, so the webhook
+# can recover both without looking up the sender; both parts are 26-char
+# base32 (campaign_short / gen_token)
+REPLY_LOCAL, _, REPLY_DOMAIN = REPLY_TO.partition("@")
+# RFC 5321 caps the local part at 64 chars; "+" and "." take two more
+if len(REPLY_LOCAL) + 2 + 26 + 26 > 64:
+    raise RuntimeError(
+        f"REPLY_TO local part {REPLY_LOCAL!r} is too long for "
+        f"per-recipient reply addresses (max 10 chars)"
+    )
+REPLY_ADDR_RE = re.compile(
+    rf"{re.escape(REPLY_LOCAL)}\+([a-z2-7]{{26}})\.([a-z2-7]{{26}})"
+    rf"@{re.escape(REPLY_DOMAIN)}",
+    re.I,
+)
+
+# serialized /campaigns and /replies responses by path + query string, so
+# polling UIs don't each hit PostgREST
+_list_cache = TTLCache(maxsize=128, ttl=5)
+_list_cache_lock = threading.Lock()
+# bumped by invalidate_lists; a fetch that started before a bump is stale
+_list_cache_gen = 0
 
 # ==================================================
 # Helpers
@@ -67,26 +166,156 @@ def extract_email(s: str) -> str:
     return m.group(1).lower() if m else ""
 
 def clean_body(text: str) -> str:
-    for marker in ("\nOn ", "\nFrom:", "\n>"):
-        if marker in text:
-            text = text.split(marker, 1)[0]
-    return text.strip()
+    # cut at the first quoted-reply marker, whichever comes first
+    m = QUOTE_RE.search(text)
+    return (text[:m.start()] if m else text).strip()
+
+def campaign_short(cid: str) -> str:
+    # 26-char base32 of the campaign UUID; reversible, unlike a hash
+    return base64.b32encode(uuid.UUID(cid).bytes).decode().rstrip("=").lower()
+
+def reply_address(cid: str, token: str) -> str:
+    try:
+        short = campaign_short(cid)
+    except ValueError:
+        return REPLY_TO
+    return f"{REPLY_LOCAL}+{short}.{token}@{REPLY_DOMAIN}"
+
+def parse_reply_address(s: str):
+    m = REPLY_ADDR_RE.fullmatch((s or "").strip())
+    if not m:
+        return None, None
+    try:
+        raw = base64.b32decode(m.group(1).upper() + "======")
+        cid = str(uuid.UUID(bytes=raw))
+    except (binascii.Error, ValueError):
+        return None, None
+    return cid, m.group(2).lower()
+
+def utcnow_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+def or_filter(q, *conditions: str):
+    # postgrest-py 0.10 has no or_(); PostgREST reads it as a plain
+    # or=(...) query parameter
+    q.params = q.params.add("or", f"({','.join(conditions)})")
+    return q
+
+def refresh_send_claim(cid: str, claim: str) -> bool:
+    # False once another /send has taken the campaign over
+    return bool(
+        get_supabase().table("campaigns")
+        .update({"sending_at": utcnow_iso()})
+        .eq("id", cid)
+        .eq("status", "sending")
+        .eq("send_claim", claim)
+        .execute()
+        .data
+    )
 
-def gen_token() -> str:
-    return secrets.token_hex(8)
+def record_sent_batch(cid: str, claim: str, tokens: list) -> bool:
+    # marks the batch's recipients sent and refreshes the claim; False once
+    # another /send has taken the campaign over
+    return bool(
+        get_supabase().rpc("record_sent_batch", {
+            "cid": cid,
+            "claim": claim,
+            "sent_tokens": tokens,
+        }).execute().data
+    )
 
-def send_email(to_email: str, subject: str, body: str):
-    resp = requests.post(
-        f"https://api.mailgun.net/v3/{MAILGUN_DOMAIN}/messages",
-        auth=("api", MAILGUN_API_KEY),
+def record_send_error(cid: str, claim: str, error: str):
+    try:
+        get_supabase().table("campaigns") \
+            .update({"send_error": error}) \
+            .eq("id", cid) \
+            .eq("send_claim", claim) \
+            .execute()
+    except Exception:
+        app.logger.exception(f"Failed to record send error for {cid}")
+
+def replies_cursor(row: dict) -> str:
+    return f"{row['received_at']},{row['id']}"
+
+def parse_replies_cursor(s: str):
+    # "<received_at ISO-8601>,<id>" as built by replies_cursor
+    ts, _, rid = s.partition(",")
+    try:
+        received_at = datetime.fromisoformat(ts.strip())
+    except ValueError:
+        return None
+    if not REPLY_ID_RE.fullmatch(rid):
+        return None
+    if received_at.tzinfo is None:
+        received_at = received_at.replace(tzinfo=timezone.utc)
+    return received_at.isoformat(), rid
+
+def is_recipient(campaign_id: str, token: str) -> bool:
+    return bool(
+        get_supabase().table("campaign_recipients")
+        .select("token")
+        .eq("campaign_id", campaign_id)
+        .eq("token", token)
+        .limit(1)
+        .execute()
+        .data
+    )
+
+def mark_replied(campaign_id: str, token: str):
+    get_supabase().table("campaign_recipients") \
+        .update({"replied_at": "now()"}) \
+        .eq("campaign_id", campaign_id) \
+        .eq("token", token) \
+        .execute()
+
+def cached_json(fetch):
+    key = request.full_path
+    with _list_cache_lock:
+        hit = _list_cache.get(key)
+        gen = _list_cache_gen
+
+    if hit is None:
+        body = jsonify(fetch()).get_data()
+        hit = (body, hashlib.blake2b(body, digest_size=8).hexdigest())
+        with _list_cache_lock:
+            # a write landed mid-fetch; serve this body but don't keep it
+            if gen == _list_cache_gen:
+                _list_cache[key] = hit
+
+    body, etag = hit
+    resp = app.response_class(body, mimetype="application/json")
+    resp.set_etag(etag)
+    # 304 with no body when If-None-Match already has this etag
+    return resp.make_conditional(request)
+
+def invalidate_lists():
+    global _list_cache_gen
+    with _list_cache_lock:
+        _list_cache_gen += 1
+        _list_cache.clear()
+
+def gen_token() -> str:
+    # 128 bits, lowercase base32 so it survives case-folding in the reply
+    # address and fits the 64-char local part next to the campaign id
+    return base64.b32encode(secrets.token_bytes(16)).decode().rstrip("=").lower()
+
+def send_batch(cid: str, subject: str, body: str, recipients: list):
+    # one Mailgun call for the whole chunk; recipient-variables keep each
+    # message addressed to a single recipient and fill in its token
+    resp = SESSION.post(
+        MAILGUN_URL,
+        auth=MAILGUN_AUTH,
         data={
             "from": FROM_EMAIL,
-            "to": to_email,
+            "to": [r["email"] for r in recipients],
             "subject": subject,
             "text": body,
-            "h:Reply-To": REPLY_TO,
+            "h:Reply-To": reply_address(cid, "%recipient.token%"),
+            "recipient-variables": orjson.dumps({
+                r["email"]: {"token": r["token"]} for r in recipients
+            }).decode(),
         },
-        timeout=20,
+        timeout=60,
     )
     resp.raise_for_status()
     return resp.json()
@@ -128,41 +357,51 @@ def mailgun_webhook():
     if not sender or not body or not message_id:
         return "OK", 200
 
-    # dedupe
-    if (
-        supabase.table("replies")
-        .select("id")
-        .eq("message_id", message_id)
-        .execute()
-        .data
-    ):
-        return "OK", 200
+    campaign_id, token = parse_reply_address(request.form.get("recipient"))
+
+    # the decoded address is only trusted if its token belongs to that
+    # campaign
+    if campaign_id and not is_recipient(campaign_id, token):
+        campaign_id = None
+
+    # unverified address, or mail sent before per-recipient Reply-To:
+    # map by sender
+    if not campaign_id:
+        rec = (
+            get_supabase().table("campaign_recipients")
+            .select("campaign_id, token")
+            .eq("email", sender)
+            .order("created_at", desc=True)
+            .limit(1)
+            .execute()
+            .data
+        )
 
-    rec = (
-        supabase.table("campaign_recipients")
-        .select("campaign_id, token")
-        .eq("email", sender)
-        .order("created_at", desc=True)
-        .limit(1)
-        .execute()
-        .data
-    )
+        if not rec:
+            return "OK", 200
 
-    if not rec:
-        return "OK", 200
+        campaign_id, token = rec[0]["campaign_id"], rec[0]["token"]
 
-    supabase.table("replies").insert({
-        "campaign_id": rec[0]["campaign_id"],
-        "recipient_email": sender,
-        "token": rec[0]["token"],
-        "subject": subject,
-        "body": clean_body(body),
-        "message_id": message_id,
-    }).execute()
+    # dedupe: a redelivered Message-Id conflicts and inserts nothing
+    inserted = get_supabase().table("replies").upsert(
+        {
+            "campaign_id": campaign_id,
+            "recipient_email": sender,
+            "token": token,
+            "subject": subject,
+            "body": clean_body(body),
+            "message_id": message_id,
+        },
+        on_conflict="message_id",
+        ignore_duplicates=True,
+    ).execute().data
+
+    if not inserted:
+        return "OK", 200
 
-    supabase.table("campaign_recipients").update({
-        "replied_at": "now()"
-    }).eq("email", sender).execute()
+    # only for a new reply, so a redelivery doesn't move replied_at
+    mark_replied(campaign_id, token)
+    invalidate_lists()
 
     return "OK", 200
 
@@ -174,18 +413,47 @@ def list_replies():
 
     campaign_id = request.args.get("campaign_id")
 
-    q = (
-        supabase.table("replies")
-        .select("*")
-        .order("received_at", desc=True)
-        .limit(1000)
-    )
+    try:
+        limit = int(request.args.get("limit", REPLIES_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "invalid limit"}), 400
+    limit = max(1, min(limit, REPLIES_MAX_PAGE_SIZE))
+
+    cursor = None
+    if request.args.get("cursor"):
+        cursor = parse_replies_cursor(request.args["cursor"])
+        if not cursor:
+            return jsonify({"error": "invalid cursor"}), 400
+
+    def fetch():
+        q = (
+            get_supabase().table("replies")
+            .select("*")
+            .order("received_at.desc,id.desc")
+            .limit(limit)
+        )
+
+        if campaign_id:
+            q = q.eq("campaign_id", campaign_id)
+
+        # rows after the previous page's last (received_at, id)
+        if cursor:
+            ts, rid = cursor
+            q = or_filter(
+                q,
+                f'received_at.lt."{ts}"',
+                f'and(received_at.eq."{ts}",id.lt.{rid})',
+            )
 
-    if campaign_id:
-        q = q.eq("campaign_id", campaign_id)
+        rows = q.execute().data or []
+        # a short page is the last one
+        more = len(rows) == limit
+        return {
+            "data": rows,
+            "next_cursor": replies_cursor(rows[-1]) if more else None,
+        }
 
-    res = q.execute()
-    return jsonify(res.data or [])
+    return cached_json(fetch)
 
 
 
@@ -195,14 +463,10 @@ def list_replies():
 @app.route("/campaigns/<cid>/replies.csv", methods=["GET"])
 def replies_csv(cid):
     # viewer = M or C
-    is_m = request.headers.get("X-M-Key") == os.environ.get("M_API_KEY")
-    is_c = request.headers.get("X-C-Key") == os.environ.get("C_API_KEY")
-
-    if not is_m and not is_c:
-        abort(403)
+    require_viewer()
 
     rows = (
-        supabase.table("replies")
+        get_supabase().table("replies")
         .select("received_at,recipient_email,token,subject,body")
         .eq("campaign_id", cid)
         .order("received_at", desc=True)
@@ -214,7 +478,7 @@ def replies_csv(cid):
     # ---------------------------
     # M-UI: include emails
     # ---------------------------
-    if is_m:
+    if is_m():
         return csv_response(
             f"campaign_{cid}_replies.csv",
             ["received_at", "recipient_email", "token", "subject", "body"],
@@ -253,13 +517,14 @@ def replies_csv(cid):
 @app.route("/campaigns", methods=["GET"])
 def list_campaigns():
     require_viewer()
-    res = (
-        supabase.table("campaigns")
+    return cached_json(lambda: (
+        get_supabase().table("campaigns")
         .select("*")
         .order("created_at", desc=True)
         .execute()
-    )
-    return jsonify(res.data or [])
+        .data
+        or []
+    ))
 
 @app.route("/campaigns", methods=["POST"])
 def create_campaign():
@@ -268,9 +533,10 @@ def create_campaign():
     if not name:
         return jsonify({"error": "name required"}), 400
 
-    res = supabase.table("campaigns").insert({
+    res = get_supabase().table("campaigns").insert({
         "name": name,
     }).execute()
+    invalidate_lists()
 
     return jsonify(res.data[0]), 200
 
@@ -283,11 +549,47 @@ def set_content(cid):
     if not subject or not body:
         return jsonify({"error": "subject and body required"}), 400
 
-    supabase.table("campaigns").update({
-        "subject": subject,
-        "body": body,
-        "status": "ready",
-    }).eq("id", cid).execute()
+    content = {"subject": subject, "body": body, "status": "ready"}
+
+    # the status guard rides on the UPDATE itself; no row back means the
+    # campaign is missing, sending or sent, or has no status yet
+    updated = (
+        get_supabase().table("campaigns")
+        .update(content)
+        .eq("id", cid)
+        .not_.in_("status", EDIT_LOCKED_STATUSES)
+        .execute()
+        .data
+    )
+
+    if not updated:
+        rows = (
+            get_supabase().table("campaigns")
+            .select("status")
+            .eq("id", cid)
+            .execute()
+            .data
+        )
+        if not rows:
+            return jsonify({"error": "campaign not found"}), 404
+        if rows[0]["status"] in EDIT_LOCKED_STATUSES:
+            return jsonify({"error": "campaign is sending or sent"}), 400
+
+        # NOT IN never matches a NULL status
+        updated = (
+            get_supabase().table("campaigns")
+            .update(content)
+            .eq("id", cid)
+            .is_("status", "null")
+            .execute()
+            .data
+        )
+
+        # the status changed between the two updates
+        if not updated:
+            return jsonify({"error": "campaign was modified concurrently"}), 400
+
+    invalidate_lists()
 
     return jsonify({"status": "ready"}), 200
 
@@ -305,15 +607,19 @@ def upload_emails(cid):
 
     # 🔴 THIS IS THE FIX (NORMALIZATION HAPPENS HERE)
     cleaned = []
+    seen = set()
     invalid = 0
+    duplicates = 0
     for raw in raw_emails:
         e = extract_email(str(raw))
         if not e:
             invalid += 1
             continue
-        cleaned.append(e.lower())
-
-    cleaned = list(dict.fromkeys(cleaned))  # dedupe
+        if e in seen:
+            duplicates += 1
+            continue
+        seen.add(e)
+        cleaned.append(e)
 
     if not cleaned:
         return jsonify({"error": "no valid emails found"}), 400
@@ -323,28 +629,125 @@ def upload_emails(cid):
         for e in cleaned
     ]
 
-    supabase.table("campaign_recipients").upsert(
+    # existing recipients keep their token; replies may already carry it
+    get_supabase().table("campaign_recipients").upsert(
         rows,
         on_conflict="campaign_id,email",
+        ignore_duplicates=True,
     ).execute()
 
     return jsonify({
         "submitted": len(raw_emails),
         "valid": len(cleaned),
-        "invalid": invalid
+        "invalid": invalid,
+        "duplicates": duplicates,
     }), 200
 
 
 
+def deliver_campaign(
+    cid: str, claim: str, subject: str, body: str, recipients: list
+):
+    sent = 0
+    failed = 0
+    claimed = True
+
+    batches = [
+        recipients[i:i + MAILGUN_BATCH_SIZE]
+        for i in range(0, len(recipients), MAILGUN_BATCH_SIZE)
+    ]
+
+    with ThreadPoolExecutor(max_workers=SEND_WORKERS) as ex:
+        futures = [
+            ex.submit(send_batch, cid, subject, body, batch)
+            for batch in batches
+        ]
+
+        for batch, fut in zip(batches, futures):
+            if fut.cancelled():
+                continue
+
+            tokens = []
+            try:
+                fut.result()
+                tokens = [r["token"] for r in batch]
+                sent += len(batch)
+            except Exception:
+                app.logger.exception(
+                    f"Failed to send batch of {len(batch)} for campaign {cid}"
+                )
+                failed += len(batch)
+
+            # mark the batch sent right away, so a job that dies later
+            # doesn't leave it to be mailed again; this also keeps the
+            # claim fresh so a long send isn't taken over
+            try:
+                if not record_sent_batch(cid, claim, tokens) and claimed:
+                    app.logger.warning(
+                        f"Campaign {cid}: send claim lost, "
+                        f"cancelling remaining batches"
+                    )
+                    claimed = False
+                    # batches already posting still finish and get marked
+                    for f in futures:
+                        f.cancel()
+            except Exception:
+                app.logger.exception(f"Failed to record sent batch for {cid}")
+
+    return sent, failed, claimed
+
+def run_campaign_send(
+    cid: str, claim: str, subject: str, body: str, recipients: list
+):
+    # runs on SEND_QUEUE, whose futures nobody reads: failures are logged
+    # and recorded on the campaign instead of raised
+    try:
+        # another /send may have taken over while this job was queued
+        if not refresh_send_claim(cid, claim):
+            app.logger.warning(f"Campaign {cid}: send claim lost, skipping")
+            return
+
+        sent, failed, claimed = deliver_campaign(
+            cid, claim, subject, body, recipients
+        )
+
+        # the newer send owns the status now
+        if not claimed:
+            return
+
+        # sets sent/partial; only a campaign still held by this claim is
+        # updated, and that row comes back (no rows means the claim was lost)
+        settled = get_supabase().rpc("finalize_campaign", {
+            "cid": cid,
+            "claim": claim,
+            "sent": sent,
+            "failed": failed,
+        }).execute().data
+    except Exception as e:
+        app.logger.exception(f"Send job for campaign {cid} failed")
+        record_send_error(cid, claim, f"{type(e).__name__}: {e}")
+        return
+    finally:
+        invalidate_lists()
+
+    if not settled:
+        app.logger.warning(
+            f"Campaign {cid}: send claim lost before finalize; "
+            f"status left to the newer send"
+        )
+
+    app.logger.info(
+        f"Campaign {cid}: sent {sent}, failed {failed}"
+    )
+
 @app.route("/campaigns/<cid>/send", methods=["POST"])
 def send_campaign(cid):
     require_m()
 
     campaign = (
-        supabase.table("campaigns")
-        .select("*")
+        get_supabase().table("campaigns")
+        .select("status")
         .eq("id", cid)
-        .single()
         .execute()
         .data
     )
@@ -352,63 +755,75 @@ def send_campaign(cid):
     if not campaign:
         return jsonify({"error": "campaign not found"}), 404
 
-    if campaign["status"] != "ready":
+    status = campaign[0]["status"]
+    if status not in SENDABLE_STATUSES and status != "sending":
         return jsonify({"error": "campaign not ready"}), 400
 
+    # only unsent recipients, and only the columns the send needs
     recipients = (
-        supabase.table("campaign_recipients")
-        .select("*")
+        get_supabase().table("campaign_recipients")
+        .select("email,token")
         .eq("campaign_id", cid)
+        .is_("sent_at", "null")
         .execute()
         .data
     )
 
-    # ✅ Filter unsent recipients in Python
-    recipients = [r for r in recipients if r["sent_at"] is None]
-
-
     if not recipients:
         return jsonify({"error": "no recipients uploaded"}), 400
 
-    sent = 0
-    failed = 0
-
-    now = datetime.now(timezone.utc).isoformat()
-    for r in recipients:
-        try:
-            send_email(
-                r["email"],
-                campaign["subject"],
-                campaign["body"],
-            )
-
-
-            supabase.table("campaign_recipients") \
-                .update({"sent_at": now}) \
-                .eq("id", r["id"]) \
-                .execute()
-
-
-            sent += 1
-        except Exception as e:
-            app.logger.exception(f"Failed to send to {r['email']}")
-            failed += 1
+    claim = secrets.token_hex(8)
+    claim_row = {
+        "status": "sending",
+        "sending_at": utcnow_iso(),
+        "send_claim": claim,
+        "send_error": None,
+    }
+
+    # claim the campaign; a concurrent send loses the race to 'sending'
+    claimed = (
+        get_supabase().table("campaigns")
+        .update(claim_row)
+        .eq("id", cid)
+        .in_("status", SENDABLE_STATUSES)
+        .execute()
+        .data
+    )
 
-    new_status = "sent" if failed == 0 else "partial"
+    if not claimed:
+        # take over a send whose job stopped refreshing its claim
+        stale = (datetime.now(timezone.utc) - SEND_CLAIM_TIMEOUT).isoformat()
+        claimed = or_filter(
+            get_supabase().table("campaigns")
+            .update(claim_row)
+            .eq("id", cid)
+            .eq("status", "sending"),
+            f'sending_at.lt."{stale}"',
+            "sending_at.is.null",
+        ).execute().data
+    invalidate_lists()
+
+    if not claimed:
+        if status == "sending":
+            return jsonify({"error": "campaign is already sending"}), 400
+        return jsonify({"error": "campaign not ready"}), 400
 
-    supabase.table("campaigns") \
-        .update({
-            "status": new_status,
-            "sent_at": now,
-        }) \
-        .eq("id", cid) \
-        .execute()
+    # send the content as of the claim, not an earlier read
+    campaign = claimed[0]
 
+    SEND_QUEUE.submit(
+        run_campaign_send,
+        cid,
+        claim,
+        campaign["subject"],
+        campaign["body"],
+        recipients,
+    )
 
     return jsonify({
-        "sent": sent,
-        "failed": failed,
-    }), 200
+        "campaign_id": cid,
+        "queued": len(recipients),
+    }), 202
 
 
 # ------------------ Recipients CSV ------------------
@@ -418,7 +833,7 @@ def recipients_csv(cid):
     require_m()
 
     rows = (
-        supabase.table("campaign_recipients")
+        get_supabase().table("campaign_recipients")
         .select("email,token,created_at,sent_at,replied_at")
         .eq("campaign_id", cid)
         .order("created_at")
@@ -496,7 +911,8 @@ def clear_all_data():
     if data.get("confirm") != "DELETE_ALL_DATA":
         return jsonify({"error": "confirmation required"}), 400
 
-    supabase.rpc("truncate_all_campaign_data").execute()
+    get_supabase().rpc("truncate_all_campaign_data").execute()
+    invalidate_lists()
     return jsonify({"status": "all data cleared"}), 200
 
 
@@ -0,0 +1,12 @@
+# gunicorn.conf.py
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+
+# threads rather than gevent: every route blocks on Supabase or Mailgun,
+# and the send pools in app.py already run on real threads
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 32))
+
+timeout = 120
@@ -0,0 +1,14 @@
+-- Replies are deduped by Mailgun Message-Id with INSERT ... ON CONFLICT DO
+-- NOTHING, which needs a unique constraint to conflict on.
+
+-- drop duplicates left by the old check-then-insert race
+delete from replies a
+using replies b
+where a.message_id = b.message_id
+  and a.ctid > b.ctid;
+
+alter table replies
+  add constraint replies_message_id_key unique (message_id);
+
+alter table campaign_recipients
+  add constraint campaign_recipients_token_key unique (token);
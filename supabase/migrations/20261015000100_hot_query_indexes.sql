@@ -0,0 +1,26 @@
+-- Indexes for the filters and orderings app.py queries on. replies.message_id
+-- and campaign_recipients.token are already covered by their unique
+-- constraints.
+
+-- /replies and /campaigns/<cid>/replies.csv
+create index if not exists replies_received_at_idx
+  on replies (received_at desc);
+create index if not exists replies_campaign_id_received_at_idx
+  on replies (campaign_id, received_at desc);
+
+-- /campaigns
+create index if not exists campaigns_created_at_idx
+  on campaigns (created_at desc);
+
+-- send: a campaign's recipients that haven't been sent yet
+create index if not exists campaign_recipients_unsent_idx
+  on campaign_recipients (campaign_id)
+  where sent_at is null;
+
+-- /campaigns/<cid>/recipients.csv
+create index if not exists campaign_recipients_campaign_id_created_at_idx
+  on campaign_recipients (campaign_id, created_at);
+
+-- webhook fallback: latest recipient row for a sender
+create index if not exists campaign_recipients_email_created_at_idx
+  on campaign_recipients (email, created_at desc);
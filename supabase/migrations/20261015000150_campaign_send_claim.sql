@@ -0,0 +1,9 @@
+-- A send claims its campaign by moving it to 'sending' with a random
+-- send_claim. The job refreshes sending_at while it runs, so a claim that
+-- stops being refreshed (restart, crashed job) can be taken over by a later
+-- /send. send_error records why the last send job failed.
+
+alter table campaigns
+  add column if not exists sending_at timestamptz,
+  add column if not exists send_claim text,
+  add column if not exists send_error text;
@@ -0,0 +1,30 @@
+-- Settles a campaign send: moves the campaign out of 'sending' with its
+-- send counts. Recipients are already marked per batch by
+-- record_sent_batch. The campaign is only settled by the job that still
+-- holds its send claim. Returns the settled campaign row, or no rows when
+-- the claim was lost (a row set rather than a scalar, so PostgREST answers
+-- with a JSON array of objects).
+
+alter table campaigns
+  add column if not exists sent_count int,
+  add column if not exists failed_count int;
+
+create or replace function finalize_campaign(
+  cid uuid,
+  claim text,
+  sent int,
+  failed int
+)
+returns setof campaigns
+language sql
+as $$
+  update campaigns
+     set status = case when failed = 0 then 'sent' else 'partial' end,
+         sent_at = now(),
+         sent_count = sent,
+         failed_count = failed
+   where id = cid
+     and status = 'sending'
+     and send_claim = claim
+  returning *;
+$$;
@@ -0,0 +1,27 @@
+-- Called by the send job after each Mailgun batch: marks that batch's
+-- recipients sent and refreshes the campaign's send claim in one round
+-- trip. Recipients are marked as soon as their batch is accepted, so a job
+-- that dies mid-send doesn't leave them to be mailed again by the /send
+-- that takes over. Returns the campaign row while the claim is still held,
+-- or no rows once another /send has taken the campaign over.
+
+create or replace function record_sent_batch(
+  cid uuid,
+  claim text,
+  sent_tokens text[]
+)
+returns setof campaigns
+language sql
+as $$
+  update campaign_recipients
+     set sent_at = now()
+   where campaign_id = cid
+     and token = any(sent_tokens);
+
+  update campaigns
+     set sending_at = now()
+   where id = cid
+     and status = 'sending'
+     and send_claim = claim
+  returning *;
+$$;
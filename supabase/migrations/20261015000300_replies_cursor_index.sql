@@ -0,0 +1,11 @@
+-- /replies pages with ORDER BY received_at DESC, id DESC and a
+-- (received_at, id) cursor; these composites serve that order directly and
+-- supersede the received_at-only indexes.
+
+create index if not exists replies_received_at_id_idx
+  on replies (received_at desc, id desc);
+create index if not exists replies_campaign_id_received_at_id_idx
+  on replies (campaign_id, received_at desc, id desc);
+
+drop index if exists replies_received_at_idx;
+drop index if exists replies_campaign_id_received_at_idx;